@@ -5,99 +5,194 @@ from sys import argv
 
 # import third-party packages
 import numpy as np
-import tifffile as tiff
 from skimage import img_as_ubyte
 from skimage.morphology import binary_opening
 #from scipy.ndimage import generate_binary_structure
 
 # import utility functions
-from .utility import mask_cell
+from .results import ResultsStore
+from .storage import open_stack, split_ext, write_stack
+from .utility import filter_saturated, mask_bbox, mask_cell, masked_stats
 
 # %%
-def batch_mask(path, pattern='GFP', mask_channel=None,
-               camera_bits=16, r=10, method='triangle', mask_open=True,
-               save_values=False, save_summary=False, save_mask=False):
+def read_channels(path, pattern, patterns):
+    """
+    Read every channel of one cell, each file only once.
+
+    Returns a dictionary with the channel pattern as key and the image as value.
+    Partner files are found by substituting each of *patterns* for *pattern* in the file name.
+    TIFF files are read whole, Zarr stores are opened lazily (see .storage.open_stack).
+    """
+    images = {}
+    for p in patterns:
+        if p not in images:
+            images[p] = open_stack(str(path).replace(pattern, p))
+    return images
+
+
+def take_channel(im, c, channel_axis=1, bbox=None):
+    """
+    Select channel c of a multi-channel stack, optionally only within bbox (slices of the other axes,
+    see .utility.mask_bbox). Both are applied in one indexing call, so from a Zarr store only the chunks
+    of that channel within the box are read. If c is None, im is a single-channel stack.
+    """
+    index = tuple(bbox) if bbox is not None else (slice(None),) * (im.ndim - (c is not None))
+    if c is not None:
+        index = index[:channel_axis] + (c,) + index[channel_axis:]
+    return np.asarray(im[index])
+
+
+def split_channels(name, im, channel_axis=1, channels=None):
+    """
+    Split a multi-channel (e.g. ImageJ ZCYX) stack into channels, optionally only the given channel indices.
+    Returns a dictionary of (image, channel index) pairs to be read with take_channel, so nothing is read yet;
+    a single-channel image keeps *name* and has index None, channels are named *name*_C1, _C2 etc.
+    """
+    if im.ndim < 4:
+        return {name: (im, None)}
+    if channels is None:
+        channels = range(im.shape[channel_axis])
+    return {name + '_C' + str(c + 1): (im, c) for c in channels}
+
+
+def batch_mask(path, pattern='GFP', mask_channel=None, channels=None, channel_axis=1,
+               camera_bits=16, r=10, method='triangle', mask_open=True, pyramid=1,
+               save_values=False, save_summary=False, save_mask=False, mask_format='tif', db=None):
     """
     Read all .tif images with a keyword and apply a 3D masking procedure
     based on a median-filtered image.
 
+    The mask is computed once per cell and applied to every measured channel.
+    Channels can be separate files (a list of patterns) or a multi-channel TIFF.
+
     Returns
     -------
     dict
         Key is the image name, value is a flat array of all intensities in the masked image.
+        Channels of a multi-channel TIFF get a _C1, _C2... suffix.
 
     Parameters
     ----------
 
     path: str
-        A path to folder with images to be processed. Must contain images in TIFF format.
-    pattern: str, optional
-        A pattern within filenames to be processed.
-    mask_channel: str, optional
-        If specified, the mask is created based on another image. 
-        Both images have to have the same name, except *mask_channel* is substituted for *pattern*.
+        A path to folder with images to be processed. Must contain images in TIFF or Zarr format.
+        Zarr stores are read lazily: only the mask channel is read whole,
+        measured channels are read within the bounding box of the mask.
+    pattern: str or list of str, optional
+        A pattern within filenames to be processed. If a list, files are found with the first pattern
+        and each of the other patterns is substituted for it to find the other channels of the same cell.
+    mask_channel: str or int, optional
+        If specified, the mask is created based on another image.
+        A string is a file pattern: both images have to have the same name,
+        except *mask_channel* is substituted for *pattern*. It is read only once if it is also measured.
+        An integer is a channel index within a multi-channel TIFF.
+        By default the mask is made from the first channel of the first pattern.
+    channels: list of int, optional
+        Indices of the channels to measure in multi-channel TIFFs. All channels by default.
+    channel_axis: int, optional
+        Channel axis of multi-channel TIFFs (1 for ImageJ hyperstacks, ZCYX).
     camera_bits: int, optional
         Ignore images with saturated pixels, based on the camera digitizer bit-depth.
+        A cell is skipped if any measured file is saturated (all channels of a multi-channel TIFF).
+        Files are checked page by page and the result is cached, see .utility.filter_saturated().
     r: int, optional
         Radius for the median filtering function.
     method: str, optional
         Which thresholding method to use. See .utility.treshold().
     mask_open: bool, optional
         If True, perform a binary opening of the mask with the default selem (3D cross).
+    pyramid: int, optional
+        Downsampling factor for coarse-to-fine masking, see .utility.mask_pyramid().
+        1 (default) computes the exact mask.
     save_values: bool, optional
         If True, write one .txt file per image with all pixel values.
     save_summary: bool, optional
-        If True, write one .csv file per image with summary statistics (mean, median, sd).
+        If True, write one .csv file with summary statistics (mean, median, sd, percentiles and skew)
+        of all images, see .utility.masked_stats().
     save_mask: bool, optional
         If True, save masks as 8-bit .tif files.
+    mask_format: str, optional
+        'tif' or 'zarr': file format of the saved masks, see .storage.write_stack().
+    db: str, optional
+        If specified, the summary statistics of each image are stored in this
+        SQLite results database together with the run parameters, see .results.ResultsStore.
     """
     # path handling through Pathlib: make output folder within current path
     path_in = Path(path)
-    # initialise a dictionary to store results
+    # initialise dictionaries to store results and their summary statistics
     pixels = {}
+    stats = {}
+
+    # a single pattern is a list of one channel
+    patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+    pattern = patterns[0]
 
     # output: prepare folder to keep masks
     if save_mask:
         path_out = path_in.joinpath('masks')  # prepare output path
         path_out.mkdir(parents=True, exist_ok=True)
         
+    # pre-flight: reject cells with saturated pixels in any measured file without reading whole stacks
+    files = sorted(path_in.glob('*' + pattern + '*'))
+    accepted = set(filter_saturated(
+        [Path(str(i).replace(pattern, p)) for i in files for p in dict.fromkeys(patterns)],
+        camera_bits))
+
     # actual function: loop over each file with pattern, mask and convert to array
-    for i in sorted(path_in.glob('*' + pattern + '*')):
-        im = tiff.imread(str(i))
-        
-        # filter out saturated images
-        if 2 ** camera_bits - 1 in im:
+    for i in files:
+        if not all(Path(str(i).replace(pattern, p)) in accepted for p in patterns):
             continue
 
-        # generate and apply mask
-        if mask_channel:
-            im_alt = tiff.imread(str(i).replace(pattern, mask_channel))
-            im_mask = mask_cell(im_alt, radius=r, method=method)
-            if mask_open:
-                im_mask = binary_opening(im_mask)
-            im_values = im[im_mask]  # mask and select values
-        else:    
-            im_mask = mask_cell(im, radius=r, method=method)
-            if mask_open:
-                im_mask = binary_opening(im_mask)
-            im_values = im[im_mask]  # mask and select values
+        # read every measured channel and the mask channel once
+        if isinstance(mask_channel, str):
+            images = read_channels(i, pattern, patterns + [mask_channel])
+        else:
+            images = read_channels(i, pattern, patterns)
+
+        # split multi-channel files, named after the file of each pattern
+        measured = {}
+        for p in patterns:
+            name = split_ext(i.name.replace(pattern, p))[0]
+            measured.update(split_channels(name, images[p], channel_axis, channels))
+
+        # pick the image the mask is based on
+        if isinstance(mask_channel, str):
+            im_alt = images[mask_channel]
+        else:
+            im_alt = images[pattern]
+        if im_alt.ndim == 4:
+            im_alt = take_channel(im_alt, mask_channel if isinstance(mask_channel, int) else 0,
+                                  channel_axis)
+
+        # generate the mask once and apply it to all channels
+        im_mask = mask_cell(im_alt, radius=r, method=method, pyramid=pyramid)
+        if mask_open:
+            im_mask = binary_opening(im_mask)
 
         # add dictionary entry with name (no extension) and pixel values
-        pixels[i.name.replace('.tif', '')] = im_values
+        # only the bounding box of the mask is read from lazy images
+        bbox = mask_bbox(im_mask)
+        for name, (im, c) in measured.items():
+            im_box = take_channel(im, c, channel_axis, bbox)
+            pixels[name] = im_box[im_mask[bbox]]  # mask and select values
+            # summary statistics in one pass over the masked region
+            if save_summary or db:
+                stats[name] = masked_stats(im_box, im_mask[bbox], camera_bits=camera_bits)
 
         # output: save masks in a subfolder
         if save_mask:
             # substitute channel and / or annotate mask in filename
-            if mask_channel:
-                mask_out = path_out.joinpath(i.name.replace(
-                    pattern, mask_channel).replace('.tif', '_mask.tif'))
+            ext = '.' + mask_format
+            if isinstance(mask_channel, str):
+                mask_out = path_out.joinpath(split_ext(i.name.replace(
+                    pattern, mask_channel))[0] + '_mask' + ext)
             else:
-                mask_out = path_out.joinpath(
-                    i.name.replace('.tif', '_mask.tif'))
-            tiff.imsave(mask_out, img_as_ubyte(im_mask))
+                mask_out = path_out.joinpath(split_ext(i.name)[0] + '_mask' + ext)
+            write_stack(mask_out, img_as_ubyte(im_mask))
             # very useful for assessing the algorithm but ultimately waste of space
-            tiff.imsave(path_out.joinpath(i.name.replace('.tif', '_masked.tif')),
-                im * im_mask)
+            for name, (im, c) in measured.items():
+                write_stack(path_out.joinpath(name + '_masked' + ext),
+                            take_channel(im, c, channel_axis) * im_mask)
 
     # output: save each dictionary entry as separate file in a subfolder
     if save_values:
@@ -114,10 +209,21 @@ def batch_mask(path, pattern='GFP', mask_channel=None,
         with path_out.open('w', newline='') as f:  # initialize a csv file for writing
             # initialize csv writer and write headers
             writer = csv.writer(f, dialect='excel')
-            writer.writerow(['cell', 'mean', 'median', 'sd'])
-            for key, value in pixels.items():
-                writer.writerow([key, round(np.mean(value), 3),
-                                 np.median(value), round(np.std(value), 3)])
+            writer.writerow(['cell', 'mean', 'median', 'sd', 'p5', 'p25', 'p75', 'p95', 'skew'])
+            for key, value in stats.items():
+                writer.writerow([key, round(value['mean'], 3), value['median'], round(value['sd'], 3)]
+                                + [value[q] for q in ('p5', 'p25', 'p75', 'p95')]
+                                + [round(value['skew'], 3)])
+
+    # output: record summary statistics with the run parameters in a results database
+    if db:
+        with ResultsStore(db) as store:
+            run_id = store.start_run('batch_mask', path_in, dict(
+                pattern = patterns, mask_channel = mask_channel, channels = channels,
+                camera_bits = camera_bits, r = r, method = method, mask_open = mask_open,
+                pyramid = pyramid))
+            for key, value in stats.items():
+                store.add_cell(run_id, key, value)
 
     # output: return dictionary of masked pixels
     return(pixels)
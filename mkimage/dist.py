@@ -1,7 +1,10 @@
 import numpy as np
-import tifffile as tiff
+from contextlib import nullcontext
 
-from .utility import (mask_cell, max_project)
+from .results import ResultsStore
+from .storage import read_stack, split_ext, write_stack
+from .utility import (filter_saturated, hist_stats, mask_cell, masked_hist, masked_stats, max_project,
+                      median_filter, threshold)
 from skimage.exposure import rescale_intensity
 from skimage import img_as_ubyte
 
@@ -18,16 +21,17 @@ def rescale_x(p):
     return p
 
 
-def prob_dist(im, make_float=False, rescale=True, make_8b=False):
+def prob_dist(im, make_float=False, rescale=True, make_8b=False, pyramid=1):
     """
     takes an image and returns (1) a sorted array of pixel intensities i
     and (2) probability that random pixel from array is bigger than i
+    pyramid > 1 computes the cell mask coarse-to-fine (see .utility.mask_pyramid)
     """
     if make_8b == True:
         im = img_as_ubyte(rescale_intensity(im, out_range='uint8'))
 
     # perform a maximum projection on image, calculate a cell mask and apply to image
-    im_mask = mask_cell(im, max=True)
+    im_mask = mask_cell(im, max=True, pyramid=pyramid)
     im_max = max_project(im)
     im_masked = im_max * im_mask
     # establish min/max pixel values of rescaled images
@@ -38,6 +42,9 @@ def prob_dist(im, make_float=False, rescale=True, make_8b=False):
     if make_float == True:
         prob = np.array([np.arange(0, 1.001, 0.001), np.zeros(1001)]).T
         im_masked = rescale_intensity(im_masked, out_range='float64')
+    elif np.issubdtype(im_masked.dtype, np.unsignedinteger):
+        # integer intensities: p(i) for every i at once from a histogram, see hist_prob
+        return hist_prob(np.bincount(im_masked.ravel()), np.sum(im_mask), rescale=rescale), im_masked
     else:
         prob = np.array([np.arange(px_min, px_max + 1),
                          np.zeros(px_max - px_min + 1)]).T
@@ -55,31 +62,180 @@ def prob_dist(im, make_float=False, rescale=True, make_8b=False):
     return prob, im_masked
 
 
-def prob_dir(path, pattern='*GFP*', rescale=True, make_8b=False):
-    # initialize paths: in/out dirs and output file for numbers
-    # using pathlib/Path makes it easier to create folders an manipulate paths than os
-    inPath = Path(path)
-    outPath = inPath.joinpath('thresholdDistribution')
-    outPath.mkdir(parents=True, exist_ok=True)
-    for i in inPath.glob(pattern):  # glob returns pattern-matching files
+def prob_hist(im, make_8b=False, pyramid=1):
+    """
+    Histograms behind prob_dist and im_skew, computed from one median filter.
+    Returns (1) the histogram of the masked maximum projection, (2) the number of pixels in that mask
+    and (3) the histogram of the 3D-masked stack. Integer images only.
+    make_8b only applies to (1) and (2), as in prob_dist; (3) uses raw intensities, as im_skew does.
+    pyramid > 1 computes the cell masks coarse-to-fine (see .utility.mask_pyramid).
+    """
+    im_max = im
+    if make_8b == True:
+        im_max = img_as_ubyte(rescale_intensity(im, out_range='uint8'))
+
+    # same masks as mask_cell(im_max, max=True) and mask_cell(im)
+    if pyramid > 1 or make_8b == True:
+        mask_max = mask_cell(im_max, max=True, pyramid=pyramid)
+        mask_3d = mask_cell(im, pyramid=pyramid)
+    else:
+        im_median = median_filter(im, 10)
+        mask_3d = im_median > threshold(im_median, 'otsu')
+        im_median = max_project(im_median)
+        mask_max = im_median > threshold(im_median, 'otsu')
 
-        # get the name of image i to modify later
-        im_path = outPath.joinpath(i.name)
+    hist_max = masked_hist(max_project(im_max), mask_max)
+    hist_3d = masked_hist(im, mask_3d)
+    return hist_max, np.sum(mask_max), hist_3d
 
-        # read image
-        im = tiff.imread(str(i))
 
-        # use the function to do the thing
-        prob, im_masked = prob_dist(im, rescale=rescale, make_8b=make_8b)
+def hist_prob(hist, n, rescale=True):
+    """
+    Same p(i) array as prob_dist, from a histogram of masked pixels and the mask size n:
+    i runs from the smallest to the largest non-zero value and p(i) = P(pixel >= i).
+    """
+    values = np.nonzero(hist[1:])[0] + 1
+    px_min, px_max = values[0], values[-1]
+    # number of pixels >= i for every i
+    tail = np.cumsum(hist[::-1])[::-1]
+    prob = np.array([np.arange(px_min, px_max + 1),
+                     tail[px_min:px_max + 1] / n]).T
+
+    if rescale == True:
+        rescale_x(prob)
 
-        # save maxed and masked image
-        tiff.imsave(str(im_path).replace('.tif', '_Masked.tif'), im_masked)
+    return prob
 
-        # save array
-        np.savetxt(str(im_path).replace('.tif', '.txt'), prob)
 
-def im_skew(im):
-    im_mask = mask_cell(im)
-    im_masked = im[im_mask]
-    s = (np.mean(im_masked) - np.median(im_masked)) / np.std(im_masked)
-    return s
+def prob_population(files, rescale=True, make_8b=False, pyramid=1, x_max=10, bins=1001):
+    """
+    Merge the p(i) curves of many cells into one population curve without keeping per-cell results.
+
+    Each cell is reduced to histograms (see prob_hist), its p(i) curve is evaluated on a common grid
+    and added to running sums, so memory depends on the grid size, not on the number of cells.
+    With rescale, the grid spans 0 to x_max in rescaled units (see rescale_x) with the given number
+    of bins; without, it is every integer intensity.
+
+    Returns
+    -------
+    population: array
+        Columns: x, mean p(x) over cells, standard deviation of p(x) over cells.
+    skew: tuple
+        Number of cells, mean and standard deviation of im_skew over cells.
+    Without any files the population is empty and the skew statistics are nan.
+    """
+    grid = np.linspace(0, x_max, bins)
+    p_sum, p_sum_sq = 0, 0
+    n_cells = 0
+    # running mean and sum of squared deviations of the skew (Welford's method)
+    skew_mean, skew_m2 = 0, 0
+
+    for i in files:
+        hist_max, n, hist_3d = prob_hist(read_stack(i), make_8b=make_8b, pyramid=pyramid)
+        prob = hist_prob(hist_max, n, rescale=rescale)
+
+        # evaluate the curve on the common grid; beyond the brightest pixel p is 0
+        if rescale:
+            p = np.interp(grid, prob[:, 0], prob[:, 1], right=0)
+        else:
+            p = np.cumsum(hist_max[::-1])[::-1] / n
+            size = max(np.size(p_sum), p.size)
+            p = np.pad(p, (0, size - p.size))
+            p_sum = np.pad(p_sum, (0, size - np.size(p_sum)))
+            p_sum_sq = np.pad(p_sum_sq, (0, size - np.size(p_sum_sq)))
+        p_sum = p_sum + p
+        p_sum_sq = p_sum_sq + p ** 2
+
+        n_cells += 1
+        skew = hist_stats(hist_3d)['skew']
+        delta = skew - skew_mean
+        skew_mean += delta / n_cells
+        skew_m2 += delta * (skew - skew_mean)
+
+    # e.g. an empty folder or every image rejected as saturated
+    if n_cells == 0:
+        return np.empty((0, 3)), (0, np.nan, np.nan)
+
+    if not rescale:
+        grid = np.arange(np.size(p_sum))
+    p_mean = p_sum / n_cells
+    p_sd = np.sqrt(np.maximum(p_sum_sq / n_cells - p_mean ** 2, 0))
+    population = np.array([grid, p_mean, p_sd]).T
+    return population, (n_cells, skew_mean, np.sqrt(skew_m2 / n_cells))
+
+
+def prob_dir(path, pattern='*GFP*', rescale=True, make_8b=False, pyramid=1, camera_bits=None,
+             db=None, aggregate=False, x_max=10, bins=1001):
+    """
+    Runs prob_dist for every image in path matching pattern and saves the distributions
+    and the masked maximum projections in a subfolder. Images are processed in name order.
+    If aggregate, only the merged population curve and skew statistics are written,
+    to population.txt (see prob_population; x_max and bins set its grid);
+    with db, the number of cells and the skew statistics are stored as a cell named 'population'.
+    If camera_bits is given, images with saturated pixels are skipped (see .utility.filter_saturated).
+    If db is given, the intensity range, masked area and integral of each distribution are also stored
+    in an SQLite results database (see .results.ResultsStore).
+    """
+    # initialize paths: in/out dirs and output file for numbers
+    # using pathlib/Path makes it easier to create folders an manipulate paths than os
+    inPath = Path(path)
+    outPath = inPath.joinpath('thresholdDistribution')
+    outPath.mkdir(parents=True, exist_ok=True)
+    files = sorted(inPath.glob(pattern))  # glob returns pattern-matching files
+    if camera_bits:
+        files = filter_saturated(files, camera_bits)
+
+    # population mode: write one compact file instead of per-cell outputs
+    if aggregate:
+        population, (n_cells, skew_mean, skew_sd) = prob_population(
+            files, rescale=rescale, make_8b=make_8b, pyramid=pyramid, x_max=x_max, bins=bins)
+        header = ('cells: ' + str(n_cells) + '\n'
+                  + 'skew mean: ' + str(skew_mean) + '\n'
+                  + 'skew sd: ' + str(skew_sd) + '\n'
+                  + 'x p_mean p_sd')
+        np.savetxt(str(outPath.joinpath('population.txt')), population, header=header)
+        if db:
+            with ResultsStore(db) as store:
+                run_id = store.start_run('prob_dir', inPath, dict(
+                    pattern = pattern, rescale = rescale, make_8b = make_8b, pyramid = pyramid,
+                    aggregate = aggregate, x_max = x_max, bins = bins))
+                store.add_cell(run_id, 'population', dict(
+                    cells = n_cells, skew_mean = skew_mean, skew_sd = skew_sd))
+        return population
+
+    # optional results database: closed (and buffered rows written) even if a file fails
+    with (ResultsStore(db) if db else nullcontext()) as store:
+        if db:
+            run_id = store.start_run('prob_dir', inPath, dict(
+                pattern = pattern, rescale = rescale, make_8b = make_8b, pyramid = pyramid))
+        for i in files:
+
+            # get the name of image i (without extension) to modify later
+            im_path = split_ext(outPath.joinpath(i.name))[0]
+
+            # read image
+            im = read_stack(i)
+
+            # use the function to do the thing
+            prob, im_masked = prob_dist(im, rescale=rescale, make_8b=make_8b,
+                                       pyramid=pyramid)
+
+            # save maxed and masked image
+            write_stack(im_path + '_Masked.tif', im_masked)
+
+            # save array
+            np.savetxt(im_path + '.txt', prob)
+
+            if db:
+                store.add_cell(run_id, split_ext(i.name)[0], dict(
+                    px_min = np.min(im_masked[np.nonzero(im_masked)]), px_max = np.max(im_masked),
+                    area = np.count_nonzero(im_masked), integral = np.sum(prob[:, 1])))
+
+def im_skew(im, im_mask=None):
+    """
+    (mean - median) / sd of the pixels within the cell, see .utility.masked_stats.
+    The mask is computed with mask_cell unless given.
+    """
+    if im_mask is None:
+        im_mask = mask_cell(im)
+    return masked_stats(im, im_mask)['skew']
@@ -0,0 +1,539 @@
+"""
+Frozen reference implementations.
+
+Copies of median_filter, threshold, erode_3d and prob_dist (with the helpers they call) as they were
+when the published patch counts were produced. They are not used by the pipelines; .validate
+compares the optimised functions of this package against them. Do not edit.
+"""
+# import numpy and skimage modules
+import numpy as np
+from skimage import filters, morphology
+from skimage.exposure import rescale_intensity
+from skimage import img_as_ubyte
+
+
+def max_project(im):
+    """ Return a maximum Z-projection of a 3D image. """
+    if im.ndim == 3:
+        im_max = np.amax(im, 0)
+        return im_max
+    else:
+        print("Error: 3-dimensional stack required")
+        return None
+
+
+def median_filter(im, radius):
+    """
+    Median filter a 2D/3D image using a circular brush of given radius.
+    On a 3D image, each slice is median-filtered separately using a 2D structuring element.
+    """
+    if len(im.shape) == 2:
+        im_median = filters.median(im, morphology.disk(radius))
+    elif len(im.shape) == 3:
+        # initialize empty image
+        im_median = np.zeros(shape=im.shape, dtype=im.dtype)
+        # fill empty image with median-filtered slices
+        for i in range(im.shape[0]):
+            im_median[i, :, :] = filters.median(
+                im[i, :, :], morphology.disk(radius))
+    else:
+        print('Cannot deal with the supplied number of dimensions.')
+        return None
+    return im_median
+
+
+def threshold(im, method):
+    '''
+    Wrapper function for common thresholding methods.
+    Takes an array and a method string, one of:
+    'li', 'otsu', 'triangle' or 'yen'.
+    Returns the threshold value.
+    '''
+    # set up a method dictionary
+    thresholding_methods = dict(
+        li = filters.threshold_li,
+        otsu = filters.threshold_otsu,
+        triangle = filters.threshold_triangle,
+        yen = filters.threshold_yen
+    )
+
+    # check if the supplied method is valid
+    if method not in thresholding_methods.keys():
+        print('Specified thresholding method not valid. Choose one of:')
+        print(*thresholding_methods.keys(), sep = '\n')
+        return None
+    
+    return thresholding_methods[method](im)
+
+
+def mask_cell(im, radius=10, method = 'otsu', max=False):
+    """
+    Return a mask (boolean array) based on thresholded median-filtered image.
+
+    Parameters
+    ----------
+    im: array-like
+        Image to be masked.
+    radius: int, optional
+        Radius for the median filtering function.
+    method: int, optional
+        Which thresholding method to use. See treshold() function.
+    max: bool, optional
+        If True, performs maximum projection of a 3D stack prior to thresholding.
+    
+    Notes
+    -----    
+    To apply mask: im[mask_cell(im)] produces a flat array of masked values.
+    im * mask_cell(im) gives a masked image.
+    """
+    im_median = median_filter(im, radius)
+    # maximum project
+    if max:
+        im_median = max_project(im_median)
+    # threshold
+    threshold_value = threshold(im_median, method)
+    im_mask = im_median > threshold_value
+    # return masked image
+    return im_mask
+
+
+def erode_3d(image, n):
+    """
+    Performs a three dimensional erosion on binary image. The 3D brush represents all
+    possible positions in a cubic array around the eroded pixel while the n parameter
+    specifies how many connections a pixel needs to have to be preserved.
+    I.e.: n = 26 means that a pixel is eroded unless it is completely surrounded by 1's,
+    n = 1 means that the pixel is preserved as long as it has 1 neighbour in 3D.
+    """
+
+    if n == 0:
+        n = 1
+        print("n set to 1; smaller values will not do anything")
+    if n > 26:
+        n = 26
+        print("n set to 26; number of neighbor pixels cannot exceed 26")
+
+    brush = np.array([
+        [  # 0
+            [
+                [1, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 1
+            [
+                [0, 1, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 2
+            [
+                [0, 0, 1],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 3
+            [
+                [0, 0, 0],
+                [1, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 4
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 5
+            [
+                [0, 0, 0],
+                [0, 0, 1],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 6
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [1, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 7
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 1, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 8
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 1]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 9
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [1, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 10
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 1, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 11
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 1],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 12
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 1],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 13
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 1]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 14
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 1, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 15
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [1, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 16
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [1, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 17
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [1, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 18
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 1, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 19
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 1],
+                [0, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 20
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [1, 0, 0],
+                [0, 0, 0]],
+        ],
+        [  # 21
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+        ],
+        [  # 22
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 1],
+                [0, 0, 0]],
+        ],
+        [  # 23
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [1, 0, 0]],
+        ],
+        [  # 24
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 1, 0]],
+        ],
+        [  # 25
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 1, 0],
+                [0, 0, 0]],
+            [
+                [0, 0, 0],
+                [0, 0, 0],
+                [0, 0, 1]],
+        ]
+    ])
+
+    image = np.pad(image, 1)
+    eroded_images = np.zeros(shape=image.shape, dtype=int) # can't sum pure bools
+
+    for i in range(26):
+        tmp = morphology.binary_erosion(image, brush[i, :, :, :])
+        eroded_images += tmp
+
+    image_out = eroded_images >= n
+    image_out = image_out[1:-1, 1:-1, 1:-1]
+
+    return image_out
+
+
+def rescale_x(p):
+    """ takes p(i) array and rescales all i values by a factor of integral """
+    p_sum = np.sum(p, axis=0)[1]
+    i = (p[:, 0] - p[0, 0]) / p_sum
+    p[:, 0] = i
+
+    return p
+
+
+def prob_dist(im, make_float=False, rescale=True, make_8b=False):
+    """
+    takes an image and returns (1) a sorted array of pixel intensities i
+    and (2) probability that random pixel from array is bigger than i
+    """
+    if make_8b == True:
+        im = img_as_ubyte(rescale_intensity(im, out_range='uint8'))
+
+    # perform a maximum projection on image, calculate a cell mask and apply to image
+    im_mask = mask_cell(im, max=True)
+    im_max = max_project(im)
+    im_masked = im_max * im_mask
+    # establish min/max pixel values of rescaled images
+    px_min = np.min(im_masked[np.nonzero(im_masked)])
+    px_max = np.max(im_masked)
+
+    # optional and mostly untested: im_float param forces (masked) picture into floating (0,1) range
+    if make_float == True:
+        prob = np.array([np.arange(0, 1.001, 0.001), np.zeros(1001)]).T
+        im_masked = rescale_intensity(im_masked, out_range='float64')
+    else:
+        prob = np.array([np.arange(px_min, px_max + 1),
+                         np.zeros(px_max - px_min + 1)]).T
+
+    # calculate p(i) = P (image > i)
+    for row in prob:
+        i = row[0]
+        p = np.sum(im_masked >= i) / np.sum(im_mask)
+        row[1] = p
+
+    # rescaling by a factor of integral on by default
+    if rescale == True:
+        rescale_x(prob)
+
+    return prob, im_masked
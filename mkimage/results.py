@@ -0,0 +1,226 @@
+# import modules for handling files and the database
+import json
+import os
+import socket
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# import third-party packages
+from skimage.measure import regionprops
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    tool TEXT NOT NULL,
+    path TEXT,
+    params TEXT NOT NULL,
+    started TEXT NOT NULL,
+    host TEXT,
+    pid INTEGER
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run_id, name)
+);
+CREATE TABLE IF NOT EXISTS cells (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    cell TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, cell, name)
+);
+CREATE TABLE IF NOT EXISTS patches (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    cell TEXT NOT NULL,
+    patch INTEGER NOT NULL,
+    volume INTEGER,
+    z REAL,
+    y REAL,
+    x REAL,
+    PRIMARY KEY (run_id, cell, patch)
+);
+CREATE INDEX IF NOT EXISTS runs_params ON runs (tool, params);
+CREATE INDEX IF NOT EXISTS parameters_value ON parameters (name, value);
+CREATE INDEX IF NOT EXISTS cells_cell ON cells (cell);
+CREATE INDEX IF NOT EXISTS patches_cell ON patches (cell);
+"""
+
+
+def patch_rows(im_labels):
+    """
+    Per-patch measurements of a labelled 3D image (e.g. the eroded image from count_patches).
+    Returns a list of (patch, volume, z, y, x) tuples with centroid coordinates.
+    """
+    return [(int(p.label), int(p.area)) + tuple(float(c) for c in p.centroid)
+            for p in regionprops(im_labels)]
+
+
+class ResultsStore:
+    """
+    SQLite store for the results of process_folder, batch_mask and prob_dir.
+
+    Every call to start_run() records a run: the tool, input path, parameters, time, host and pid.
+    Per-cell values and per-patch measurements are buffered and inserted in batches of
+    batch_size rows, each batch in its own transaction. The database uses write-ahead logging
+    and waits for locks, so several processes can write to the same file.
+
+    Parameters
+    ----------
+    path: str
+        The database file; created if it does not exist.
+    batch_size: int, optional
+        Number of buffered rows that triggers an insert.
+    timeout: float, optional
+        Seconds to wait for another writer to release the database.
+    """
+
+    def __init__(self, path, batch_size=1000, timeout=60):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA busy_timeout=' + str(int(timeout * 1000)))
+        self.connection.executescript(SCHEMA)
+        self.cells = []
+        self.patches = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _transaction(self, function, retries=10):
+        """ Run function(connection) inside one write transaction, retrying if the database stays locked. """
+        for attempt in range(retries):
+            try:
+                # take the write lock up front so the transaction cannot fail halfway
+                self.connection.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+                continue
+            try:
+                result = function(self.connection)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def start_run(self, tool, path, params):
+        """ Record a new run and its parameters (a dictionary); returns the run id. """
+        # parameters as canonical JSON: identical parameter sets give identical strings
+        params = {key: json.dumps(value) for key, value in sorted(params.items())}
+        params_key = json.dumps(params, sort_keys=True)
+        started = datetime.now(timezone.utc).isoformat()
+
+        def insert(c):
+            run_id = c.execute(
+                'INSERT INTO runs (tool, path, params, started, host, pid) VALUES (?, ?, ?, ?, ?, ?)',
+                (tool, str(path), params_key, started, socket.gethostname(), os.getpid())).lastrowid
+            c.executemany('INSERT INTO parameters (run_id, name, value) VALUES (?, ?, ?)',
+                          [(run_id, key, value) for key, value in params.items()])
+            return run_id
+        return self._transaction(insert)
+
+    def add_cell(self, run_id, cell, values):
+        """ Buffer per-cell values, a dictionary of name: number. """
+        self.cells.extend((run_id, cell, name, float(value)) for name, value in values.items())
+        if len(self.cells) >= self.batch_size:
+            self.flush()
+
+    def add_patches(self, run_id, cell, rows):
+        """ Buffer per-patch rows of (patch, volume, z, y, x), see patch_rows(). """
+        self.patches.extend((run_id, cell) + tuple(row) for row in rows)
+        if len(self.patches) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Insert all buffered rows in one transaction. """
+        if not self.cells and not self.patches:
+            return
+        cells, patches = self.cells, self.patches
+
+        def insert(c):
+            c.executemany('INSERT OR REPLACE INTO cells (run_id, cell, name, value) VALUES (?, ?, ?, ?)',
+                          cells)
+            c.executemany('INSERT OR REPLACE INTO patches (run_id, cell, patch, volume, z, y, x) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?)', patches)
+        self._transaction(insert)
+        self.cells, self.patches = [], []
+
+    def close(self):
+        """ Flush buffered rows and close the database. """
+        self.flush()
+        self.connection.close()
+
+
+def _run_filter(tool, params):
+    """ SQL condition and arguments selecting runs by tool and parameter values. """
+    conditions, args = [], []
+    if tool is not None:
+        conditions.append('runs.tool = ?')
+        args.append(tool)
+    for key, value in params.items():
+        conditions.append('runs.id IN (SELECT run_id FROM parameters WHERE name = ? AND value = ?)')
+        args.extend([key, json.dumps(value)])
+    return conditions, args
+
+
+def load_cells(path, tool=None, cell=None, **params):
+    """
+    Load per-cell results from a results database, e.g. load_cells(db, 'process_folder', method='yen').
+
+    Runs can be selected by tool and by any parameter values given as keyword arguments,
+    cells by name. Returns a list of dictionaries, one per run and cell,
+    with 'run_id', 'cell' and one entry per stored value.
+    """
+    conditions, args = _run_filter(tool, params)
+    if cell is not None:
+        conditions.append('cells.cell = ?')
+        args.append(cell)
+    query = ('SELECT cells.run_id, cells.cell, cells.name, cells.value FROM cells '
+             'JOIN runs ON runs.id = cells.run_id')
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY cells.run_id, cells.cell'
+
+    connection = sqlite3.connect(str(path))
+    try:
+        rows = connection.execute(query, args).fetchall()
+    finally:
+        connection.close()
+
+    # pivot name/value rows into one dictionary per run and cell
+    results = {}
+    for run_id, cell_name, name, value in rows:
+        results.setdefault((run_id, cell_name), dict(run_id=run_id, cell=cell_name))[name] = value
+    return list(results.values())
+
+
+def load_patches(path, tool=None, cell=None, **params):
+    """
+    Load per-patch results as a list of (run_id, cell, patch, volume, z, y, x) tuples.
+    Runs and cells are selected as in load_cells().
+    """
+    conditions, args = _run_filter(tool, params)
+    if cell is not None:
+        conditions.append('patches.cell = ?')
+        args.append(cell)
+    query = ('SELECT patches.run_id, patches.cell, patch, volume, z, y, x FROM patches '
+             'JOIN runs ON runs.id = patches.run_id')
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY patches.run_id, patches.cell, patch'
+
+    connection = sqlite3.connect(str(path))
+    try:
+        return connection.execute(query, args).fetchall()
+    finally:
+        connection.close()
@@ -1,21 +1,41 @@
 # import modules for handling files
 import csv
+from contextlib import nullcontext
 from pathlib import Path
 from sys import argv
 
 # import third-party packages
 import numpy as np
 import skimage as sk
-import tifffile as tiff
 from skimage.measure import label
 from skimage.exposure import rescale_intensity
 
 # import utility functions
-from .utility import (cell_area, erode_3d, mask_cell, threshold, subtract_median)
+from .results import ResultsStore, patch_rows
+from .storage import read_stack, split_ext, write_stack
+from .utility import (cell_area, count_components, erode_3d, erode_fast,
+                      filter_saturated, mask_cell, threshold_fast, subtract_median)
+
+
+def count_spots(im_spots, threshold_value, erosion_n=3, con=2, loop=False):
+    """
+    Count-only version of the thresholding, erosion and labelling steps of count_patches.
+    Returns the same number of patches without building the thresholded, eroded or labelled volumes
+    as separate outputs: erosion works on neighbour counts and components are counted with union-find.
+    """
+    im_eroded = erode_fast(im_spots > threshold_value, erosion_n)
+    if loop:
+        # loop erosion as long as the image is changing
+        while True:
+            im_check = erode_fast(im_eroded, erosion_n)
+            if np.array_equal(im_check, im_eroded):
+                break
+            im_eroded = im_check
+    return count_components(im_eroded, con)
 
 
 def count_patches(im, median_radius=10, erosion_n=3, con=2,
-                  method='yen', mask=False, loop=False):
+                  method='yen', mask=False, loop=False, count_only=False):
 
     """
     Count the number of spots and the cross-section area in a 3D image of a single yeast cell.
@@ -38,15 +58,20 @@ def count_patches(im, median_radius=10, erosion_n=3, con=2,
      - method, str: method for thresholding; refer to .utility.threshold docstring for a list of allowed methods (default 'yen')
      - mask, bool: if True, spot thresholding ignores background *outside* of the cell (default False)
      - loop, bool: if True, erosion iterates until the image stops changing (default False)
+     - count_only, bool: if True, only count and area are computed (see count_spots)
+     and images is returned as None (default False)
     """
 
     im_spots = subtract_median(im, median_radius)
 
     if mask:
-        im_masked = im_spots[mask_cell(im)]
-        threshold_value = threshold(im_masked, method)
+        threshold_value = threshold_fast(im_spots, method, mask_cell(im))
     else:
-        threshold_value = threshold(im_spots, method)
+        threshold_value = threshold_fast(im_spots, method)
+
+    if count_only:
+        count = count_spots(im_spots, threshold_value, erosion_n, con, loop)
+        return count, cell_area(im), None
 
     # threshold
     im_threshold = im_spots > threshold_value
@@ -77,42 +102,71 @@ def count_patches(im, median_radius=10, erosion_n=3, con=2,
     return count, area, images
 
 
+def output_paths(path, median_radius=10, erosion_n=3, con=2, method='yen', mask=False, loop=False):
+    """
+    Return the output folder and csv file of process_folder for a set of parameters.
+    The folder name encodes the parameters, e.g. yen_r10_n3_con2_mask.
+    """
+    outPath = Path(path).joinpath(method
+                                  + '_r' + str(median_radius)
+                                  + '_n' + str(erosion_n)
+                                  + '_con' + str(con)
+                                  + '_mask' * mask
+                                  + '_loop' * loop)
+    outCsv = outPath.joinpath(method + '_n' + str(erosion_n) + "_count.csv")
+    return outPath, outCsv
+
+
 def process_folder(path, pattern='*GFP*',
                    median_radius=10, erosion_n=3, con=2, method='yen',
-                   mask=False, loop=False, save_images=False):
+                   mask=False, loop=False, save_images=False, camera_bits=None,
+                   image_format='tif', db=None):
     """
     Runs the patch counter function for every image in given path that matches pattern,
     GFP by default. If save_images, the intermediate processed images are saved
     (median filter subtracted, thresholded and final eroded and labeled image).
+    If camera_bits is given, images with saturated pixels are skipped
+    (checked page by page and cached, see .utility.filter_saturated).
+    Images can be TIFF files or Zarr stores; image_format ('tif' or 'zarr') sets the format
+    of the saved intermediates (see .storage.write_stack).
+    If db is a path, counts, areas and per-patch volumes and centroids are also stored
+    in an SQLite results database together with the run parameters (see .results.ResultsStore).
     """
 
     # initialize paths: in/out dirs and output file for numbers
     # using pathlib/Path makes it easier to create folders an manipulate paths than os
 
     inPath = Path(path)
-    outPath = inPath.joinpath(method
-                              + '_r' + str(median_radius)
-                              + '_n' + str(erosion_n)
-                              + '_con' + str(con)
-                              + '_mask' * mask
-                              + '_loop' * loop)
+    outPath, outCsv = output_paths(inPath, median_radius, erosion_n, con, method, mask, loop)
     outPath.mkdir(parents=True, exist_ok=True)
-    outCsv = outPath.joinpath(method + '_n' + str(erosion_n) + "_count.csv")
 
-    with outCsv.open('w', newline='') as f:  # initialize a csv file for writing
+    # optional results database: closed (and buffered rows written) even if a file fails
+    with (ResultsStore(db) if db else nullcontext()) as store, \
+            outCsv.open('w', newline='') as f:  # initialize a csv file for writing
+
+        # one run per call, parameters recorded with it
+        if db:
+            run_id = store.start_run('process_folder', inPath, dict(
+                pattern = pattern, median_radius = median_radius, erosion_n = erosion_n,
+                con = con, method = method, mask = mask, loop = loop))
 
         # initialize csv writer and write headers
         writer = csv.writer(f, dialect='excel')
         writer.writerow(['Cell', 'Threshold', 'Patches', 'Cross_Area'])
 
+        files = sorted(inPath.glob(pattern))  # glob returns pattern-matching files
+        if camera_bits:
+            files = filter_saturated(files, camera_bits)
+
         # iterate over files
-        for i in sorted(inPath.glob(pattern)):  # glob returns pattern-matching files
+        for i in files:
 
-            # join the output path and image name
-            im_path = outPath.joinpath(i.name)
+            # join the output path and image name, without extension
+            im_path = split_ext(outPath.joinpath(i.name))[0].replace(pattern, '')
+            ext = '.' + image_format
 
             # read image
-            im = tiff.imread(str(i))
+            im = read_stack(i)
 
             # use counting function
             count, area, images = count_patches(im,
@@ -121,30 +175,32 @@ def process_folder(path, pattern='*GFP*',
                                                 con = con,
                                                 method = method,
                                                 mask = mask,
-                                                loop = loop)
+                                                loop = loop,
+                                                count_only = not (save_images or db))
 
             # save patch count and area with csv writer
-            writer.writerow([i.name.replace('.tif', ''),
+            writer.writerow([split_ext(i.name)[0],
                              method, str(count), area])
 
+            if db:
+                store.add_cell(run_id, split_ext(i.name)[0], dict(patches = count, area = area))
+                store.add_patches(run_id, split_ext(i.name)[0], patch_rows(images[2]))
+
             if save_images: 
                 # save median-subtracted image as 16-bit
                 im_spots = images[0, :, :, :]
                 im_spots = sk.img_as_uint(im_spots)
-                tiff.imsave(str(im_path).replace(pattern, '').replace(
-                    '.tif', '_MD.tif'), im_spots)
+                write_stack(im_path + '_MD' + ext, im_spots)
 
                 # convert boolean into 16-bit image
                 im_thresholded = images[1, :, :, :]
                 im_thresholded = sk.img_as_uint(im_thresholded)
-                tiff.imsave(str(im_path).replace(pattern, '').replace(
-                    '.tif', '_Thresholded_' + method + '.tif'), im_thresholded)
+                write_stack(im_path + '_Thresholded_' + method + ext, im_thresholded)
 
                 # save enumerated sites as 16-bit
                 im_eroded = images[2, :, :, :]
                 im_eroded = sk.img_as_uint(im_eroded)
-                tiff.imsave(str(im_path).replace(pattern, '').replace(
-                    '.tif', '_Eroded' + '_n' + str(erosion_n) + '.tif'), im_eroded)
+                write_stack(im_path + '_Eroded' + '_n' + str(erosion_n) + ext, im_eroded)
 
 # get the path from command line and run counting function
 if __name__ == "__main__": # only executed if ran as script
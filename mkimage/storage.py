@@ -0,0 +1,139 @@
+# import modules for handling files
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# import third-party packages
+import numpy as np
+import tifffile as tiff
+
+# zarr is optional, only needed for chunked storage
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def is_zarr(path):
+    """ True if path points to a Zarr / OME-Zarr store (a .zarr directory). """
+    return Path(path).suffix == '.zarr'
+
+
+def image_stat(path):
+    """
+    Size and modification time (ns) of a TIFF file or Zarr store, e.g. to notice changed images.
+    For a store, the size is the total over all its files and the time the latest of its files
+    and folders, since rewriting a chunk does not change the store directory itself.
+    """
+    if not is_zarr(path):
+        stat = Path(path).stat()
+        return stat.st_size, stat.st_mtime_ns
+    size, mtime = 0, Path(path).stat().st_mtime_ns
+    for root, dirs, files in os.walk(str(path)):
+        for name in dirs:
+            mtime = max(mtime, os.stat(os.path.join(root, name)).st_mtime_ns)
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            size, mtime = size + stat.st_size, max(mtime, stat.st_mtime_ns)
+    return size, mtime
+
+
+def split_ext(path):
+    """
+    Split a file name into the part before the image extension and the extension itself.
+    Knows .tif, .tiff, .zarr and .ome.zarr; e.g. 'cell_GFP.ome.zarr' -> ('cell_GFP', '.ome.zarr').
+    """
+    path = str(path)
+    for ext in ('.ome.zarr', '.zarr', '.tiff', '.tif'):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return path, ''
+
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError('Reading and writing .zarr stores requires the zarr package.')
+
+
+def open_stack(path):
+    """
+    Open an image for reading.
+
+    TIFF files are read whole and returned as numpy arrays. Zarr stores are returned as
+    lazy zarr arrays: indexing reads only the chunks it touches, e.g. im[i] reads one Z-plane.
+    For OME-Zarr groups the full-resolution level of the first multiscale image is returned.
+    """
+    if not is_zarr(path):
+        return tiff.imread(str(path))
+    _require_zarr()
+    node = zarr.open(str(path), mode='r')
+    if hasattr(node, 'shape'):
+        return node
+    # OME-Zarr: datasets are listed from the highest resolution down
+    attrs = node.attrs.asdict()
+    multiscales = attrs.get('multiscales', attrs.get('ome', {}).get('multiscales'))
+    return node[multiscales[0]['datasets'][0]['path']]
+
+
+def read_stack(path):
+    """ Read a whole TIFF or Zarr image into a numpy array. """
+    return np.asarray(open_stack(path)[...])
+
+
+def iter_planes(path):
+    """
+    Yield 2D planes of a TIFF or Zarr image one at a time, without reading the whole image.
+    TIFF files are read page by page, Zarr arrays plane by plane over the leading axes.
+    """
+    if not is_zarr(path):
+        with tiff.TiffFile(str(path)) as tif:
+            for page in tif.pages:
+                yield page.asarray()
+        return
+    im = open_stack(path)
+    for index in np.ndindex(*im.shape[:-2]):
+        yield im[index]
+
+
+def write_stack(path, im, chunks=None, ome=False, workers=4):
+    """
+    Write an image to a TIFF file or, if path ends in .zarr, a Zarr store.
+
+    Zarr stores are chunked by Z-plane by default (chunks=(1, ..., y, x)) and written
+    in slabs of whole chunks in parallel, so each worker only touches its own chunks.
+    If ome is True (or path ends in .ome.zarr) the array is written as level '0'
+    of a single-scale OME-Zarr (NGFF 0.4) image, which requires Zarr format 2.
+    """
+    if not is_zarr(path):
+        tiff.imwrite(str(path), im)
+        return
+    _require_zarr()
+    im = np.asarray(im)
+    if chunks is None:
+        chunks = (1,) * (im.ndim - 2) + im.shape[-2:]
+
+    ome = ome or str(path).endswith('.ome.zarr')
+    # NGFF 0.4 is defined on Zarr format 2; zarr 3 writes format 3 unless told otherwise
+    zarr_format = dict(zarr_format=2) if ome and int(zarr.__version__.split('.')[0]) >= 3 else {}
+    if ome:
+        group = zarr.open_group(str(path), mode='w', **zarr_format)
+        axes = [dict(name=a, type='space') for a in 'zyx'[-im.ndim:]]
+        axes = [dict(name='c', type='channel')] * (im.ndim - len(axes)) + axes
+        group.attrs['multiscales'] = [dict(
+            version = '0.4',
+            axes = axes,
+            datasets = [dict(path = '0', coordinateTransformations = [
+                dict(type = 'scale', scale = [1.0] * im.ndim)])]
+        )]
+        array_path = str(Path(path).joinpath('0'))
+    else:
+        array_path = str(path)
+    out = zarr.open_array(store=array_path, mode='w', shape=im.shape, chunks=chunks, dtype=im.dtype,
+                          **zarr_format)
+
+    # one slab of whole chunks along the first axis per task; chunks never overlap between tasks
+    step = chunks[0]
+    def write(start):
+        out[start:start + step] = im[start:start + step]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(write, range(0, im.shape[0], step)))
@@ -0,0 +1,144 @@
+# import modules for handling files
+import csv
+from pathlib import Path
+from sys import argv
+
+# import third-party packages
+import numpy as np
+import tifffile as tiff
+
+# import utility functions
+from .utility import (downscale, max_project, median_filter, subtract_median, threshold,
+                      threshold_fast)
+from .site_counter import count_spots
+
+
+def iter_frames(path, nz=None):
+    """
+    Yield (t, frame) for every time point of a time-lapse TIFF, reading one 3D stack at a time.
+
+    Parameters
+    ----------
+    path: str
+        A TZYX stack, e.g. an ImageJ hyperstack.
+    nz: int, optional
+        Number of slices per frame. Only needed if the file does not store its axes,
+        in which case pages are grouped into frames of nz slices.
+        A plain 3D stack without nz is treated as a single frame.
+    """
+    with tiff.TiffFile(str(path)) as tif:
+        series = tif.series[0]
+        if nz is None:
+            nz = series.shape[1] if len(series.shape) == 4 else len(series.pages)
+        n_frames = len(series.pages) // nz
+        for t in range(n_frames):
+            # only the pages of frame t are decoded
+            frame = tif.asarray(key=range(t * nz, (t + 1) * nz), series=0)
+            yield t, frame.reshape((nz,) + series.shape[-2:])
+
+
+def frame_similarity(im_a, im_b, factor=8):
+    """
+    Pearson correlation between coarse maximum projections of two 3D stacks.
+    Values close to 1 mean the cell has not moved or changed shape much.
+    """
+    a = downscale(max_project(im_a), factor).ravel()
+    b = downscale(max_project(im_b), factor).ravel()
+    return np.corrcoef(a, b)[0, 1]
+
+
+def count_timelapse(path, nz=None, median_radius=10, erosion_n=3, con=2, method='yen',
+                    mask=False, loop=False, min_similarity=0.98, max_reuse=10,
+                    reuse_threshold=False, out_csv=None):
+    """
+    Count patches in every frame of a time-lapse movie of a single cell.
+
+    Frames are read one at a time (see iter_frames) and counted as in count_patches
+    with count_only=True. The cell mask and cross-section area are only recomputed
+    on key frames: a frame reuses the mask of the last key frame if their frame_similarity
+    is at least min_similarity and fewer than max_reuse frames have reused it so far.
+    Peak memory stays at a few frames.
+
+    Returns
+    -------
+    list
+        One [frame, threshold value, count, area, reused] row per frame.
+        The rows are also written to out_csv, by default next to the movie with a _timelapse.csv suffix.
+
+    Parameters
+    ----------
+    path: str
+        A TZYX TIFF file.
+    nz: int, optional
+        Number of slices per frame, see iter_frames().
+    median_radius, erosion_n, con, method, mask, loop:
+        Same as in .site_counter.count_patches().
+    min_similarity: float, optional
+        Minimum correlation with the key frame to reuse its cell mask.
+    max_reuse: int, optional
+        Maximum number of consecutive frames reusing a key frame's mask.
+    reuse_threshold: bool, optional
+        If True, frames that reuse the mask also reuse the key frame's spot threshold.
+    out_csv: str, optional
+        Output file for the per-frame time series.
+    """
+    path = Path(path)
+    if out_csv is None:
+        out_csv = path.with_name(path.name.replace('.tif', '') + '_timelapse.csv')
+
+    rows = []
+    key_frame = None
+    n_reused = 0
+    key_threshold = None
+
+    with Path(out_csv).open('w', newline='') as f:  # initialize a csv file for writing
+
+        # initialize csv writer and write headers
+        writer = csv.writer(f, dialect='excel')
+        writer.writerow(['Frame', 'Threshold', 'Value', 'Patches', 'Cross_Area', 'Reused'])
+
+        for t, im in iter_frames(path, nz):
+
+            # decide whether the cell is still where it was on the key frame
+            reuse = bool(key_frame is not None and n_reused < max_reuse
+                         and frame_similarity(im, key_frame) >= min_similarity)
+
+            if reuse:
+                n_reused += 1
+            else:
+                # new key frame: one median filter gives both the 3D mask and the projected area,
+                # same as mask_cell(im) and cell_area(im)
+                key_frame = im
+                n_reused = 0
+                im_median = median_filter(im, 10)
+                im_mask = im_median > threshold(im_median, 'otsu')
+                im_median = max_project(im_median)
+                area = np.sum(im_median > threshold(im_median, 'otsu'))
+                del im_median
+
+            im_spots = subtract_median(im, median_radius)
+
+            if reuse and reuse_threshold:
+                threshold_value = key_threshold
+            elif mask:
+                threshold_value = threshold_fast(im_spots, method, im_mask)
+            else:
+                threshold_value = threshold_fast(im_spots, method)
+            if not reuse:
+                key_threshold = threshold_value
+
+            count = count_spots(im_spots, threshold_value, erosion_n, con, loop)
+
+            # write each frame as soon as it is counted
+            row = [t, threshold_value, count, area, reuse]
+            writer.writerow([t, method, threshold_value, count, area, int(reuse)])
+            f.flush()
+            rows.append(row)
+
+    return rows
+
+
+# get the path from command line and run counting function
+if __name__ == "__main__":  # only executed if ran as script
+    path = argv[1]
+    count_timelapse(path, mask=True)
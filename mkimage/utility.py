@@ -1,9 +1,131 @@
+# import modules for handling files
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
 # import numpy and skimage modules
 import numpy as np
 import skimage as sk
 import tifffile as tiff
 from skimage import filters, morphology
 
+from .storage import image_stat, iter_planes
+
+
+def scan_saturation(path, camera_bits=16):
+    """
+    Check a TIFF file or Zarr store for saturated pixels one page at a time, without reading the whole stack.
+    Stops at the first page containing a saturated pixel (2 ** camera_bits - 1).
+    Returns (saturated, maximum); after an early stop, maximum is the largest value seen so far.
+    """
+    value = 2 ** camera_bits - 1
+    im_max = 0
+    for im in iter_planes(path):
+        page_max = int(im.max())
+        im_max = max(im_max, page_max)
+        # only search for the exact value if the page can contain it
+        if page_max >= value and value in im:
+            return True, im_max
+    return False, im_max
+
+
+def lock_file(lock, timeout=60):
+    """
+    Wait until the lock file can be created exclusively (O_CREAT | O_EXCL, atomic on a shared
+    filesystem). Locks older than timeout seconds were left by a crashed process and are removed.
+    The caller removes the lock when done.
+    """
+    while True:
+        try:
+            os.close(os.open(str(lock), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(str(lock)).st_mtime > timeout:
+                    os.unlink(str(lock))
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+
+
+def filter_saturated(files, camera_bits=16, index_name='saturation_index.json'):
+    """
+    Return the files that have no saturated pixels, see scan_saturation().
+
+    Results are kept in a sidecar index (a .json file in the folder of each image) together with
+    the file size and modification time, so later runs skip rejected files without decoding them.
+    Changed files are scanned again; for Zarr stores, any rewritten chunk counts as a change (see image_stat).
+    Several processes can share an index: new entries are merged into the file on disk when it is written.
+    """
+    accepted = []
+    indexes = {}
+    scanned = {}  # index path: entries scanned in this run
+    for i in files:
+        i = Path(i)
+        # load the index of this folder once
+        index_path = i.parent.joinpath(index_name)
+        if index_path not in indexes:
+            if index_path.exists():
+                with index_path.open() as f:
+                    indexes[index_path] = json.load(f)
+            else:
+                indexes[index_path] = {}
+        index = indexes[index_path]
+
+        size, mtime = image_stat(i)
+        entry = index.get(i.name)
+        if (entry is None or entry['size'] != size
+                or entry['mtime'] != mtime or entry['camera_bits'] != camera_bits):
+            saturated, im_max = scan_saturation(i, camera_bits)
+            entry = dict(size = size, mtime = mtime,
+                         camera_bits = camera_bits, saturated = saturated, max = im_max)
+            index[i.name] = entry
+            scanned.setdefault(index_path, {})[i.name] = entry
+
+        if not entry['saturated']:
+            accepted.append(i)
+
+    # write indexes through a temporary file so an interrupted run leaves them intact;
+    # under a lock, re-read the index first to keep entries other processes added in the meantime
+    for index_path, entries in scanned.items():
+        lock = index_path.with_name(index_path.name + '.lock')
+        lock_file(lock)
+        try:
+            index = {}
+            if index_path.exists():
+                with index_path.open() as f:
+                    index = json.load(f)
+            index.update(entries)
+            # a unique temporary name, so processes writing the same index do not collide
+            fd, index_tmp = tempfile.mkstemp(prefix=index_path.name + '.', suffix='.tmp',
+                                             dir=str(index_path.parent))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(index_tmp, str(index_path))
+        finally:
+            os.unlink(str(lock))
+
+    return accepted
+
+
+def mask_bbox(im_mask):
+    """
+    Return a tuple of slices spanning the non-zero region of a mask.
+    im[mask_bbox(mask)] only reads the chunks of a lazy (e.g. Zarr) image that the mask touches
+    and im[bbox][mask[bbox]] gives the same values as im[mask].
+    """
+    bbox = []
+    for axis in range(im_mask.ndim):
+        # project onto one axis and find the first and last non-zero index
+        other = tuple(a for a in range(im_mask.ndim) if a != axis)
+        index = np.nonzero(np.any(im_mask, axis=other))[0]
+        if index.size == 0:
+            return tuple(slice(0, 0) for _ in range(im_mask.ndim))
+        bbox.append(slice(index[0], index[-1] + 1))
+    return tuple(bbox)
+
 
 def max_project(im):
     """ Return a maximum Z-projection of a 3D image. """
@@ -68,7 +190,128 @@ def threshold(im, method):
     return thresholding_methods[method](im)
 
 
-def mask_cell(im, radius=10, method = 'otsu', max=False):
+def median_at(im, radius, index, chunk=4096):
+    """
+    Median filter a 2D image at selected pixels only.
+    Gives the same values as median_filter(im, radius)[index] without filtering the whole image;
+    index is a (y, x) tuple of coordinate arrays, e.g. from np.nonzero().
+    """
+    # offsets of every pixel in the circular brush relative to its centre
+    dy, dx = np.nonzero(morphology.disk(radius))
+    dy, dx = dy - radius, dx - radius
+    # edge padding reproduces the 'nearest' border mode of filters.median
+    im_pad = np.pad(im, radius, mode='edge')
+    y, x = index[0] + radius, index[1] + radius
+    values = np.zeros(shape=y.shape, dtype=im.dtype)
+    # gather neighbourhoods in chunks to keep the temporary array small
+    for i in range(0, y.size, chunk):
+        yc, xc = y[i:i+chunk, None], x[i:i+chunk, None]
+        # the disk has an odd number of pixels so the median is an actual pixel value
+        values[i:i+chunk] = np.median(im_pad[yc + dy, xc + dx], axis=1)
+    return values
+
+
+def downscale(im, factor):
+    """
+    Downsample a 2D image or each slice of a 3D stack by averaging factor x factor blocks.
+    Edges are padded to a multiple of factor; returns a float array.
+    """
+    ny, nx = im.shape[-2:]
+    pad_y, pad_x = -ny % factor, -nx % factor
+    pad = [(0, 0)] * (im.ndim - 2) + [(0, pad_y), (0, pad_x)]
+    im_pad = np.pad(im, pad, mode='edge')
+    shape = im.shape[:-2] + ((ny + pad_y) // factor, factor, (nx + pad_x) // factor, factor)
+    return im_pad.reshape(shape).mean(axis=(-3, -1))
+
+
+def mask_pyramid(im, radius=10, method='otsu', max=False, factor=4):
+    """
+    Coarse-to-fine approximation of mask_cell().
+    Each slice is downsampled by block averaging, median-filtered with a proportionally smaller
+    radius and thresholded at coarse scale. The coarse mask is upsampled and only a band
+    around its outline is refined with a full-resolution median filter.
+    Use mask_agreement() to compare the result to the exact mask.
+    """
+    im_2d = im.ndim == 2
+    if im_2d:
+        im = im[np.newaxis, :, :]
+    nz, ny, nx = im.shape
+    im_coarse = downscale(im, factor)
+
+    # downsample slices, then coarse median filter and threshold
+    im_coarse = median_filter(im_coarse, np.maximum(1, round(radius / factor)))
+    if max:
+        im_coarse = max_project(im_coarse)[np.newaxis, :, :]
+    threshold_value = threshold(im_coarse, method)
+    mask_coarse = im_coarse > threshold_value
+
+    # refinement band: coarse pixels with a differently classified neighbour, in-plane only
+    brush = np.ones((1, 3, 3), dtype=bool)
+    band_coarse = (morphology.binary_dilation(mask_coarse, brush)
+                   & ~morphology.binary_erosion(mask_coarse, brush))
+
+    # upsample mask and band back to full resolution
+    def upsample(a):
+        return a.repeat(factor, axis=1).repeat(factor, axis=2)[:, :ny, :nx]
+    im_mask = upsample(mask_coarse)
+    band = upsample(band_coarse)
+
+    # refine the band with full-resolution medians
+    if max:
+        index = np.nonzero(band[0])
+        values = np.zeros(shape=index[0].shape, dtype=im.dtype)
+        for i in range(nz):
+            values = np.maximum(values, median_at(im[i], radius, index))
+        im_mask[0][index] = values > threshold_value
+    else:
+        for i in range(nz):
+            index = np.nonzero(band[i])
+            im_mask[i][index] = median_at(im[i], radius, index) > threshold_value
+
+    if im_2d or max:
+        im_mask = im_mask[0]
+    return im_mask
+
+
+def mask_agreement(im_mask, im_reference):
+    """
+    Compare an approximate mask to a reference mask.
+    Returns a dictionary with the Dice coefficient, both areas (pixel counts),
+    and the absolute and relative area difference.
+    """
+    area = int(np.sum(im_mask))
+    area_reference = int(np.sum(im_reference))
+    overlap = int(np.sum(im_mask & im_reference))
+    if area + area_reference == 0:
+        dice = 1.0
+    else:
+        dice = 2 * overlap / (area + area_reference)
+    return dict(
+        dice = dice,
+        area = area,
+        area_reference = area_reference,
+        area_difference = area - area_reference,
+        area_ratio = area / area_reference if area_reference else np.nan
+    )
+
+
+def threshold_fast(im, method, im_mask=None):
+    """
+    Same value as threshold(im[im_mask], method) without copying the masked pixels.
+    For unsigned integer images, 'otsu' and 'yen' are computed from a histogram built slice by slice
+    (see masked_hist); other methods and image types go through threshold().
+    """
+    if method in ('otsu', 'yen') and np.issubdtype(im.dtype, np.unsignedinteger):
+        hist = masked_hist(im, im_mask)
+        values = np.nonzero(hist)[0]
+        # trim to the range of values, as skimage does for integer images
+        if values.size and values[0] != values[-1]:
+            hist = (hist[values[0]:values[-1] + 1], np.arange(values[0], values[-1] + 1))
+            return dict(otsu = filters.threshold_otsu, yen = filters.threshold_yen)[method](hist=hist)
+    return threshold(im if im_mask is None else im[im_mask], method)
+
+
+def mask_cell(im, radius=10, method = 'otsu', max=False, pyramid=1):
     """
     Return a mask (boolean array) based on thresholded median-filtered image.
 
@@ -82,12 +325,17 @@ def mask_cell(im, radius=10, method = 'otsu', max=False):
         Which thresholding method to use. See treshold() function.
     max: bool, optional
         If True, performs maximum projection of a 3D stack prior to thresholding.
+    pyramid: int, optional
+        Downsampling factor for coarse-to-fine masking, see mask_pyramid().
+        1 (default) computes the exact mask at full resolution.
     
     Notes
     -----    
     To apply mask: im[mask_cell(im)] produces a flat array of masked values.
     im * mask_cell(im) gives a masked image.
     """
+    if pyramid > 1:
+        return mask_pyramid(im, radius, method, max, pyramid)
     im_median = median_filter(im, radius)
     # maximum project
     if max:
@@ -99,10 +347,91 @@ def mask_cell(im, radius=10, method = 'otsu', max=False):
     return im_mask
 
 
-def cell_area(im, radius=10):
+def masked_hist(im, im_mask=None):
+    """
+    Histogram (np.bincount) of the pixels of an integer image within a mask, or of the whole image.
+    Built one slice at a time, so at most one slice of masked values is copied.
+    """
+    hist = np.zeros(1, dtype=np.int64)
+    planes = range(im.shape[0]) if im.ndim == 3 else [Ellipsis]
+    for i in planes:
+        values = im[i] if im_mask is None else im[i][im_mask[i]]
+        plane_hist = np.bincount(values.ravel())
+        # grow the histogram to the largest value seen so far
+        if plane_hist.size > hist.size:
+            hist = np.pad(hist, (0, plane_hist.size - hist.size))
+        hist[:plane_hist.size] += plane_hist
+    return hist
+
+
+def _empty_stats(percentiles):
+    """ Statistics of an empty mask: n is 0 and every statistic is nan, as np.median of no values. """
+    stats = dict(n = 0, mean = np.nan, sd = np.nan, median = np.nan)
+    for q in percentiles:
+        stats['p' + str(q)] = np.nan
+    stats['skew'] = np.nan
+    stats['saturated'] = np.nan
+    return stats
+
+
+def hist_stats(hist, percentiles=(5, 25, 75, 95), camera_bits=16):
+    """
+    Summary statistics of pixel values from their histogram (see masked_hist).
+
+    Returns a dictionary with n, mean, sd, median, the requested percentiles (p5, p25...),
+    skew as defined in dist.im_skew ((mean - median) / sd) and the fraction of saturated pixels
+    (value 2 ** camera_bits - 1 or above). Values match np.mean, np.std, np.median and np.percentile.
+    An empty histogram (e.g. a mask emptied by binary_opening) gives nan for every statistic.
+    """
+    values = np.arange(hist.size)
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1]) if hist.size else 0
+    if n == 0:
+        return _empty_stats(percentiles)
+    mean = np.sum(values * hist) / n
+    sd = np.sqrt(np.sum(hist * (values - mean) ** 2) / n)
+
+    def percentile(q):
+        # linear interpolation between the closest ranks, as np.percentile
+        rank = (n - 1) * q / 100
+        low, high = np.searchsorted(cumulative, [np.floor(rank), np.ceil(rank)], side='right')
+        return low + (high - low) * (rank - np.floor(rank))
+
+    median = percentile(50)
+    stats = dict(n = n, mean = mean, sd = sd, median = median)
+    for q in percentiles:
+        stats['p' + str(q)] = percentile(q)
+    stats['skew'] = (mean - median) / sd
+    stats['saturated'] = np.sum(hist[2 ** camera_bits - 1:]) / n
+    return stats
+
+
+def masked_stats(im, im_mask=None, percentiles=(5, 25, 75, 95), camera_bits=16):
+    """
+    Mean, sd, median, percentiles, skew and saturated fraction of the pixels within a mask,
+    from a single histogram pass over the image (see masked_hist and hist_stats).
+    Images that are not unsigned integers fall back to numpy functions on the masked values.
+    """
+    if np.issubdtype(im.dtype, np.unsignedinteger):
+        return hist_stats(masked_hist(im, im_mask), percentiles, camera_bits)
+
+    values = im[im_mask] if im_mask is not None else np.ravel(im)
+    if values.size == 0:
+        return _empty_stats(percentiles)
+    mean, sd, median = np.mean(values), np.std(values), np.median(values)
+    stats = dict(n = values.size, mean = mean, sd = sd, median = median)
+    for q in percentiles:
+        stats['p' + str(q)] = np.percentile(values, q)
+    stats['skew'] = (mean - median) / sd
+    stats['saturated'] = np.mean(values >= 2 ** camera_bits - 1)
+    return stats
+
+
+def cell_area(im, radius=10, pyramid=1):
     """ Return pixel area estimate of cell cross section.
-    Only one ROI per image is counted so thresholding has to be unambiguous. """
-    im_mask = mask_cell(im, max=True)
+    Only one ROI per image is counted so thresholding has to be unambiguous.
+    If pyramid > 1, the mask is computed coarse-to-fine (see mask_pyramid). """
+    im_mask = mask_cell(im, max=True, pyramid=pyramid)
     area = np.sum(im_mask)
     return area
 
@@ -542,3 +871,107 @@ def erode_3d(image, n):
 
     return image_out
 
+
+
+def neighbour_count(image):
+    """
+    Count the non-zero 3D neighbours (out of 26) of every pixel in a binary image.
+    Returns a uint8 array of the same shape; pixels outside the image count as zero.
+    """
+    image = np.pad(image > 0, 1).astype(np.uint8)
+    nz, ny, nx = image.shape
+    counts = np.zeros(shape=(nz - 2, ny - 2, nx - 2), dtype=np.uint8)
+    for dz in range(3):
+        for dy in range(3):
+            for dx in range(3):
+                if (dz, dy, dx) != (1, 1, 1):
+                    counts += image[dz:nz-2+dz, dy:ny-2+dy, dx:nx-2+dx]
+    return counts
+
+
+def erode_fast(image, n):
+    """
+    Same result as erode_3d, computed from neighbour counts instead of 26 binary erosions.
+    A pixel is preserved if it is non-zero and has at least n non-zero neighbours in 3D.
+    """
+    if n == 0:
+        n = 1
+        print("n set to 1; smaller values will not do anything")
+    if n > 26:
+        n = 26
+        print("n set to 26; number of neighbor pixels cannot exceed 26")
+
+    image = image > 0
+    return image & (neighbour_count(image) >= n)
+
+
+def count_components(image, con=2):
+    """
+    Count connected components in a 3D binary image without building a label image.
+    Same count as skimage.measure.label(image, connectivity=con, return_num=True)[1].
+
+    Foreground pixels are run-length encoded along x; runs in neighbouring rows that touch
+    (with diagonal contact allowed depending on con) are merged with a vectorised union-find.
+    """
+    image = np.asarray(image) > 0
+    nz, ny, nx = image.shape
+
+    # run-length encode every (z, y) row: starts and ends (exclusive) of foreground runs
+    rows = np.pad(image.reshape(nz * ny, nx), ((0, 0), (1, 1))).astype(np.int8)
+    edges = np.diff(rows, axis=1)
+    row, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    n_runs = row.size
+    if n_runs == 0:
+        return 0
+
+    # runs come out sorted by row and start, so composite keys are sorted too
+    width = nx + 2
+    start_key = row * width + start
+    end_key = row * width + end
+    z, y = np.divmod(row, ny)
+
+    # neighbouring rows preceding each run; faces count 1, edges 2, corners 3 towards con
+    run_a, run_b = [], []
+    for dz, dy in ((0, -1), (-1, -1), (-1, 0), (-1, 1)):
+        order = abs(dz) + abs(dy)
+        if order > con:
+            continue
+        # allow diagonal contact along x if one more non-zero offset is permitted
+        slack = int(order < con)
+        valid = (z + dz >= 0) & (y + dy >= 0) & (y + dy < ny)
+        if not valid.any():
+            continue
+        i = np.nonzero(valid)[0]
+        nb_row = (row[i] + dz * ny + dy) * width
+        # candidate runs in the neighbour row: end > start - slack and start < end + slack
+        lo = np.searchsorted(end_key, nb_row + start[i] - slack, side='right')
+        hi = np.searchsorted(start_key, nb_row + end[i] + slack, side='left')
+        n_pairs = np.maximum(hi - lo, 0)
+        if not n_pairs.any():
+            continue
+        run_a.append(np.repeat(i, n_pairs))
+        # enumerate lo, lo + 1, ..., hi - 1 for every run
+        offsets = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        run_b.append(np.repeat(lo, n_pairs) + offsets)
+
+    if not run_a:
+        return n_runs
+    run_a, run_b = np.concatenate(run_a), np.concatenate(run_b)
+
+    # union-find: hook the larger root onto the smaller one, then compress paths fully
+    parent = np.arange(n_runs)
+    while True:
+        root_a, root_b = parent[run_a], parent[run_b]
+        linked = root_a != root_b
+        if not linked.any():
+            break
+        np.minimum.at(parent, np.maximum(root_a, root_b)[linked],
+                      np.minimum(root_a, root_b)[linked])
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    return int(np.sum(parent == np.arange(n_runs)))
@@ -0,0 +1,205 @@
+"""
+Differential validation of the optimised functions against the frozen reference implementations.
+
+Every check generates random and synthetic inputs, runs the reference from .reference and the
+function used by the pipelines on the same input, and compares the outputs: exact equality for
+integer and boolean outputs, a tolerance for floating point outputs and bounds on the Dice
+coefficient and area difference for the approximate pyramid mask. Run all checks with
+
+    python -m mkimage.validate [cases] [seed]
+
+which prints the number of mismatches and the speedup of each optimised path
+and exits with status 1 if anything differs.
+"""
+# import modules for timing and the command line
+import sys
+import time
+
+# import numpy and skimage modules
+import numpy as np
+import skimage as sk
+from skimage.measure import label
+
+# import the reference and the optimised functions
+from . import reference
+from .dist import prob_dist
+from .site_counter import count_patches
+from .utility import erode_fast, mask_agreement, mask_cell, median_at, threshold_fast
+
+# tolerances of the coarse-to-fine mask against the full-resolution mask (see check_pyramid)
+MIN_DICE = 0.98
+MAX_AREA_DIFFERENCE = 0.02  # relative to the reference area
+
+
+def synthetic_cell(rng, shape=(10, 96, 96), spots=30):
+    """
+    A 12-bit 3D stack of an ellipsoid cell with bright spots on a noisy background,
+    with randomised size, brightness, noise and spot positions.
+    """
+    nz, ny, nx = shape
+    z, y, x = np.mgrid[:nz, :ny, :nx]
+    radii = rng.uniform(0.25, 0.4, 2) * (ny, nx)
+    r = np.sqrt(((y - ny / 2) / radii[0]) ** 2 + ((x - nx / 2) / radii[1]) ** 2
+                + ((z - nz / 2) / (nz / 2.2)) ** 2)
+    im = (rng.uniform(100, 300) + rng.uniform(300, 1000) * (r < 1)
+          + rng.normal(0, rng.uniform(10, 60), shape))
+    for _ in range(spots):
+        cz, cy, cx = rng.integers(1, nz - 1), rng.integers(2, ny - 2), rng.integers(2, nx - 2)
+        im[cz-1:cz+2, cy-1:cy+2, cx-1:cx+2] += rng.uniform(500, 2000) * (r[cz, cy, cx] < 1)
+    return np.clip(im, 0, 4095).astype(np.uint16)
+
+
+def random_binary(rng):
+    """ A random 3D binary volume of random shape and density. """
+    shape = (rng.integers(1, 12), rng.integers(4, 40), rng.integers(4, 40))
+    return rng.random(shape) < rng.uniform(0.05, 0.7)
+
+
+def random_image(rng):
+    """ A random unsigned integer image (2D or 3D) with a skewed intensity distribution. """
+    shape = tuple(rng.integers(4, 40, rng.integers(2, 4)))
+    dtype = rng.choice([np.uint8, np.uint16])
+    im = rng.gamma(rng.uniform(1, 5), rng.uniform(2, 30), shape)
+    return np.clip(im, 0, np.iinfo(dtype).max).astype(dtype)
+
+
+def reference_count(im, median_radius=10, erosion_n=3, con=2, method='yen', mask=False):
+    """ Patch count and cross-section area of count_patches computed with the reference functions only. """
+    im_spots = sk.img_as_uint(im.astype(int) - reference.median_filter(im, median_radius).astype(int))
+    if mask:
+        threshold_value = reference.threshold(im_spots[reference.mask_cell(im)], method)
+    else:
+        threshold_value = reference.threshold(im_spots, method)
+    im_eroded = reference.erode_3d(im_spots > threshold_value, erosion_n)
+    count = label(im_eroded, connectivity=con, return_num=True)[1]
+    return count, np.sum(reference.mask_cell(im, max=True))
+
+
+# every check returns (description, reference function, optimised function, comparison)
+def check_erode(rng):
+    im, n = random_binary(rng), int(rng.integers(1, 27))
+    return ('shape ' + str(im.shape) + ', n ' + str(n),
+            lambda: reference.erode_3d(im, n), lambda: erode_fast(im, n), np.array_equal)
+
+
+def check_median_at(rng):
+    im, radius = random_image(rng), int(rng.integers(1, 7))
+    im = im if im.ndim == 2 else im[0]
+    index = tuple(rng.integers(0, s, 50) for s in im.shape)
+    return ('shape ' + str(im.shape) + ', radius ' + str(radius),
+            lambda: reference.median_filter(im, radius)[index], lambda: median_at(im, radius, index),
+            np.array_equal)
+
+
+def check_threshold(rng):
+    im = random_image(rng)
+    im_mask = rng.random(im.shape) < rng.uniform(0.2, 1)
+    im_mask.flat[:2] = True
+    method = str(rng.choice(['li', 'otsu', 'triangle', 'yen']))
+    return ('shape ' + str(im.shape) + ', ' + str(im.dtype) + ', ' + method,
+            lambda: reference.threshold(im[im_mask], method),
+            lambda: threshold_fast(im, method, im_mask),
+            lambda a, b: np.isclose(a, b, rtol=1e-9, atol=0))
+
+
+def check_pyramid(rng):
+    im = synthetic_cell(rng, spots=int(rng.integers(0, 30)))
+    factor, max = int(rng.integers(2, 9)), bool(rng.integers(2))
+    def same(a, b):
+        agreement = mask_agreement(b, a)
+        return (agreement['dice'] >= MIN_DICE
+                and abs(agreement['area_difference']) <= MAX_AREA_DIFFERENCE * agreement['area_reference'])
+    return ('pyramid ' + str(factor) + ', max ' + str(max),
+            lambda: reference.mask_cell(im, max=max), lambda: mask_cell(im, max=max, pyramid=factor),
+            same)
+
+
+def check_count(rng):
+    im = synthetic_cell(rng, spots=int(rng.integers(5, 60)))
+    params = dict(median_radius = int(rng.integers(3, 11)), erosion_n = int(rng.integers(1, 8)),
+                  con = int(rng.integers(1, 4)), method = str(rng.choice(['otsu', 'yen'])),
+                  mask = bool(rng.integers(2)), count_only = bool(rng.integers(2)))
+    return (str(params),
+            lambda: reference_count(im, **{k: v for k, v in params.items() if k != 'count_only'}),
+            lambda: count_patches(im, **params)[:2],
+            lambda a, b: tuple(a) == tuple(b))
+
+
+def check_prob_dist(rng):
+    im = synthetic_cell(rng, spots=int(rng.integers(0, 30)))
+    rescale = bool(rng.integers(2))
+    def same(a, b):
+        return (a[0].shape == b[0].shape and np.allclose(a[0], b[0], rtol=1e-9, atol=1e-12)
+                and np.array_equal(a[1], b[1]))
+    return ('rescale ' + str(rescale),
+            lambda: reference.prob_dist(im, rescale=rescale),
+            lambda: prob_dist(im, rescale=rescale), same)
+
+
+CHECKS = dict(
+    erode_3d = check_erode,
+    median_at = check_median_at,
+    threshold = check_threshold,
+    mask_pyramid = check_pyramid,
+    count_patches = check_count,
+    prob_dist = check_prob_dist
+)
+
+
+def validate(cases=20, seed=0, checks=None, verbose=True):
+    """
+    Run the differential checks and report mismatches and speedups.
+
+    Returns
+    -------
+    list
+        One dictionary per check: name, number of cases, mismatching case descriptions,
+        total reference and optimised run time and the speedup.
+
+    Parameters
+    ----------
+    cases: int, optional
+        Number of random cases per check.
+    seed: int, optional
+        Seed of the random generator; the same seed gives the same cases.
+    checks: list of str, optional
+        Names of the checks to run (keys of CHECKS), all by default.
+    verbose: bool, optional
+        If True, print a report.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for name in checks or CHECKS:
+        time_reference, time_fast = 0, 0
+        mismatches = []
+        for _ in range(cases):
+            description, run_reference, run_fast, same = CHECKS[name](rng)
+            start = time.perf_counter()
+            expected = run_reference()
+            time_reference += time.perf_counter() - start
+            start = time.perf_counter()
+            result = run_fast()
+            time_fast += time.perf_counter() - start
+            if not same(expected, result):
+                mismatches.append(description)
+        results.append(dict(name = name, cases = cases, mismatches = mismatches,
+                            time_reference = time_reference, time_fast = time_fast,
+                            speedup = time_reference / time_fast))
+
+    if verbose:
+        print('check            cases  mismatches  reference [s]  optimised [s]  speedup')
+        for r in results:
+            print('{name:<16} {cases:>5}  {n:>10}  {time_reference:>13.3f}  {time_fast:>13.3f}  '
+                  '{speedup:>6.1f}x'.format(n=len(r['mismatches']), **r))
+        for r in results:
+            for description in r['mismatches']:
+                print('MISMATCH ' + r['name'] + ': ' + description)
+    return results
+
+
+# run all checks from the command line
+if __name__ == "__main__":  # only executed if ran as script
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    results = validate(cases, seed)
+    sys.exit(1 if any(r['mismatches'] for r in results) else 0)
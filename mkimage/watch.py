@@ -0,0 +1,202 @@
+# import modules for handling files and processes
+import csv
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from sys import argv
+
+# import third-party packages
+import numpy as np
+import tifffile as tiff
+from skimage.morphology import binary_opening
+
+# import utility functions
+from .site_counter import count_patches
+from .storage import is_zarr, read_stack, split_ext
+from .utility import filter_saturated, mask_cell, masked_stats
+
+
+def count_file(path, median_radius=10, erosion_n=3, con=2, method='yen', mask=False, loop=False):
+    """ Count patches in one image, returning a process_folder csv row. """
+    count, area, _ = count_patches(read_stack(path), median_radius=median_radius,
+                                   erosion_n=erosion_n, con=con, method=method,
+                                   mask=mask, loop=loop, count_only=True)
+    return [split_ext(Path(path).name)[0], method, str(count), area]
+
+
+def mask_file(path, r=10, method='triangle', mask_open=True, pyramid=1, camera_bits=16):
+    """
+    Mask one image as batch_mask does, returning a summary row (cell, mean, median, sd).
+    Like batch_mask, images with saturated pixels are rejected (see .utility.filter_saturated):
+    None is returned for them.
+    """
+    if not filter_saturated([path], camera_bits):
+        return None
+    im = read_stack(path)
+    im_mask = mask_cell(im, radius=r, method=method, pyramid=pyramid)
+    if mask_open:
+        im_mask = binary_opening(im_mask)
+    stats = masked_stats(im, im_mask)
+    return [split_ext(Path(path).name)[0], round(stats['mean'], 3),
+            stats['median'], round(stats['sd'], 3)]
+
+
+TASKS = dict(
+    count = (count_file, ['Cell', 'Threshold', 'Patches', 'Cross_Area']),
+    mask = (mask_file, ['cell', 'mean', 'median', 'sd'])
+)
+
+
+def is_readable(path):
+    """ True if the whole image can be parsed, i.e. a TIFF file is not truncated. """
+    if is_zarr(path):
+        return True
+    try:
+        with tiff.TiffFile(str(path)) as tif:
+            tif.pages[-1].asarray()
+    except Exception:
+        return False
+    return True
+
+
+def watch_folder(path, pattern='*GFP*', task='count', out_csv=None, poll=1.0, settle=2.0,
+                 processes=None, latency_target=60.0, idle_timeout=None, max_files=None,
+                 max_settles=5, **params):
+    """
+    Process images as they appear in a folder, e.g. while the microscope is writing them.
+
+    The folder is scanned every *poll* seconds. A new file matching *pattern* is considered complete
+    once its size and modification time have not changed for *settle* seconds and it can be parsed.
+    A file that still cannot be parsed after *max_settles* settle periods is reported and skipped.
+    Complete files are sent to a pool of worker processes that stays up for the whole session
+    and each result is appended to the csv file as soon as it is ready.
+    Files already listed in the csv are skipped, so a watch can be restarted.
+
+    Returns
+    -------
+    dict
+        Number of processed files, mean and maximum latency and the number of files over the target.
+
+    Parameters
+    ----------
+    path: str
+        The folder to watch.
+    pattern: str, optional
+        Files to process, as in process_folder.
+    task: str, optional
+        'count' runs count_patches (as process_folder, see count_file),
+        'mask' runs the masking pipeline of batch_mask on single images (see mask_file),
+        including its saturation check: saturated images are reported and skipped.
+    out_csv: str, optional
+        Output file, watch_<task>.csv in the watched folder by default. Besides the usual
+        columns it records the latency (seconds from the last write of the file to its result)
+        and the backlog (files waiting or being processed) when the result was written.
+    poll: float, optional
+        Seconds between folder scans.
+    settle: float, optional
+        Seconds a file must stay unchanged before it is processed.
+    processes: int, optional
+        Number of worker processes, all CPUs by default.
+    latency_target: float, optional
+        A warning is printed for every file whose latency exceeds this many seconds.
+    idle_timeout: float, optional
+        Stop after this many seconds without new files and with nothing left to do.
+        By default, watch until interrupted.
+    max_files: int, optional
+        Stop after processing this many files.
+    max_settles: int, optional
+        Number of settle periods an unchanged but unreadable file is retried before it is skipped.
+    **params:
+        Passed on to count_file or mask_file, e.g. method='otsu'.
+    """
+    function, header = TASKS[task]
+    path = Path(path)
+    out_csv = Path(out_csv) if out_csv else path.joinpath('watch_' + task + '.csv')
+
+    # skip files processed in an earlier session
+    done = set()
+    if out_csv.exists():
+        with out_csv.open(newline='') as f:
+            done = {row[0] for row in list(csv.reader(f))[1:]}
+    new_csv = not out_csv.exists()
+
+    candidates = {}  # file: (size, mtime, time the file was last seen changing)
+    running = {}  # file: (AsyncResult, mtime)
+    latencies = []
+    last_activity = time.time()
+
+    with Pool(processes) as pool, out_csv.open('a', newline='') as f:
+        writer = csv.writer(f, dialect='excel')
+        if new_csv:
+            writer.writerow(header + ['Latency', 'Backlog'])
+            f.flush()
+
+        try:
+            while max_files is None or len(latencies) < max_files:
+                now = time.time()
+
+                # look for new or still growing files
+                for i in sorted(path.glob(pattern)):
+                    if i == out_csv or i in running or split_ext(i.name)[0] in done:
+                        continue
+                    stat = i.stat()
+                    size, mtime = stat.st_size, stat.st_mtime
+                    if i not in candidates or candidates[i][:2] != (size, mtime):
+                        candidates[i] = (size, mtime, now)
+                        last_activity = now
+                    elif now - candidates[i][2] >= settle:
+                        if is_readable(i):
+                            # unchanged for long enough: hand over to the worker pool
+                            running[i] = (pool.apply_async(function, (str(i),), params), mtime)
+                            del candidates[i]
+                        elif now - candidates[i][2] >= settle * max_settles:
+                            # unchanged but still not parsable: not an image being written, skip it
+                            print('Could not read ' + i.name + ', skipped')
+                            done.add(split_ext(i.name)[0])
+                            del candidates[i]
+
+                # write finished results in the order they complete
+                for i in [i for i, (result, _) in running.items() if result.ready()]:
+                    result, mtime = running.pop(i)
+                    try:
+                        row = result.get()
+                    except Exception as error:
+                        # report and skip files the pipeline cannot handle
+                        print('Could not process ' + i.name + ': ' + str(error))
+                        done.add(split_ext(i.name)[0])
+                        continue
+                    if row is None:
+                        # rejected by the pipeline, e.g. saturated pixels in mask mode
+                        print('Skipped ' + i.name)
+                        done.add(split_ext(i.name)[0])
+                        continue
+                    latency = time.time() - mtime
+                    backlog = len(candidates) + len(running)
+                    writer.writerow(row + [round(latency, 3), backlog])
+                    f.flush()
+                    done.add(row[0])
+                    latencies.append(latency)
+                    last_activity = time.time()
+                    if latency > latency_target:
+                        print('Latency target exceeded for ' + i.name + ': '
+                              + str(round(latency, 1)) + ' s, backlog ' + str(backlog))
+
+                if (idle_timeout is not None and not candidates and not running
+                        and time.time() - last_activity > idle_timeout):
+                    break
+                time.sleep(poll)
+        except KeyboardInterrupt:
+            pass
+
+    return dict(
+        files = len(latencies),
+        mean_latency = np.mean(latencies) if latencies else np.nan,
+        max_latency = np.max(latencies) if latencies else np.nan,
+        over_target = int(np.sum(np.array(latencies) > latency_target))
+    )
+
+
+# get the path from command line and start watching
+if __name__ == "__main__":  # only executed if ran as script
+    path = argv[1]
+    watch_folder(path)
@@ -0,0 +1,218 @@
+# import modules for handling files and processes
+import csv
+import os
+import socket
+import threading
+import time
+import uuid
+from multiprocessing import Process
+from pathlib import Path
+from sys import argv
+
+# import utility functions
+from .site_counter import output_paths
+from .storage import split_ext
+from .watch import count_file
+
+
+def claim(lease, lease_timeout=600):
+    """
+    Try to take the lease file for one image; returns the owner string written to the lease
+    if this process now owns it, None otherwise.
+
+    Leases are created with O_CREAT | O_EXCL, which is atomic on a shared filesystem, so only one
+    process can hold a lease. A lease whose modification time is older than lease_timeout seconds
+    belongs to a dead worker: it is moved aside with an atomic rename and claimed again.
+    The owner string is unique to this claim; heartbeat and release check it (see owns),
+    so a worker whose lease was taken over never refreshes or removes the new owner's lease.
+    """
+    owner = socket.gethostname() + ' ' + str(os.getpid()) + ' ' + uuid.uuid4().hex
+    for attempt in range(2):
+        try:
+            fd = os.open(str(lease), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.stat(str(lease)).st_mtime
+            except FileNotFoundError:
+                continue  # released in the meantime, try again
+            if age < lease_timeout or attempt:
+                return None
+            # stale lease: only one process can rename it away
+            stale = lease.with_name(lease.name + '.' + owner.replace(' ', '.'))
+            try:
+                os.rename(str(lease), str(stale))
+            except FileNotFoundError:
+                return None
+            if time.time() - os.stat(str(stale)).st_mtime < lease_timeout:
+                # another worker reclaimed it just before us: put the live lease back if we can;
+                # if a third worker took the name meanwhile, the owner check in heartbeat and release
+                # keeps the two live owners from touching each other's lease
+                try:
+                    os.link(str(stale), str(lease))
+                except FileExistsError:
+                    pass
+                os.unlink(str(stale))
+                return None
+            os.unlink(str(stale))
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+        return owner
+    return None
+
+
+def owns(lease, owner):
+    """ True if the lease file exists and still holds this owner string. """
+    try:
+        with open(str(lease)) as f:
+            return f.read() == owner
+    except FileNotFoundError:
+        return False
+
+
+def release(lease, owner):
+    """ Remove the lease, unless it has been taken over by another worker. """
+    if owns(lease, owner):
+        try:
+            os.unlink(str(lease))
+        except FileNotFoundError:
+            pass
+
+
+def heartbeat(lease, owner, interval, stop):
+    """
+    Touch the lease every interval seconds until stop is set, so it does not look stale.
+    Stops once the lease no longer belongs to owner.
+    """
+    while not stop.wait(interval):
+        if not owns(lease, owner):
+            return
+        try:
+            os.utime(str(lease))
+        except FileNotFoundError:
+            return
+
+
+def write_result(result, row):
+    """ Write one csv row to its own file atomically: the file appears complete or not at all. """
+    result_tmp = result.with_name(result.name + '.' + str(os.getpid()) + '.tmp')
+    with result_tmp.open('w', newline='') as f:
+        csv.writer(f, dialect='excel').writerow(row)
+    os.replace(str(result_tmp), str(result))
+
+
+def merge_results(files, results_path, out_csv):
+    """ Merge per-file results into one csv, in the same order as the image files. """
+    out_tmp = out_csv.with_name(out_csv.name + '.' + str(os.getpid()) + '.tmp')
+    with out_tmp.open('w', newline='') as f:
+        writer = csv.writer(f, dialect='excel')
+        writer.writerow(['Cell', 'Threshold', 'Patches', 'Cross_Area'])
+        for i in files:
+            with results_path.joinpath(i.name + '.csv').open(newline='') as r:
+                writer.writerows(csv.reader(r))
+    os.replace(str(out_tmp), str(out_csv))
+
+
+def work(path, pattern='*GFP*', median_radius=10, erosion_n=3, con=2, method='yen',
+         mask=False, loop=False, lease_timeout=600, poll=5.0):
+    """
+    Process a folder together with any number of other workers, without a coordinator.
+
+    Every process or node pointed at the same folder runs this function. Workers claim images
+    through lease files on the shared filesystem (see claim), keep their leases fresh while counting
+    and store each result in its own file. Leases of dead workers go stale after lease_timeout
+    seconds and are taken over. When every image has a result, the results are merged into
+    the same csv file process_folder writes, in file name order. Images that cannot be processed
+    get a row without count and area, and the error is saved next to the results (queue/results/*.error).
+
+    Returns
+    -------
+    int
+        Number of images processed by this worker.
+
+    Parameters
+    ----------
+    path: str
+        The shared folder with images.
+    pattern, median_radius, erosion_n, con, method, mask, loop:
+        Same as in process_folder.
+    lease_timeout: float, optional
+        Seconds after which a lease that is no longer refreshed is considered abandoned.
+    poll: float, optional
+        Seconds to wait before checking again for images leased by other workers.
+    """
+    inPath = Path(path)
+    outPath, outCsv = output_paths(inPath, median_radius, erosion_n, con, method, mask, loop)
+    leases_path = outPath.joinpath('queue', 'leases')
+    results_path = outPath.joinpath('queue', 'results')
+    leases_path.mkdir(parents=True, exist_ok=True)
+    results_path.mkdir(parents=True, exist_ok=True)
+
+    params = dict(median_radius=median_radius, erosion_n=erosion_n, con=con,
+                  method=method, mask=mask, loop=loop)
+    files = sorted(inPath.glob(pattern))  # glob returns pattern-matching files
+    processed = 0
+
+    while True:
+        pending = [i for i in files if not results_path.joinpath(i.name + '.csv').exists()]
+        if not pending:
+            break
+
+        claimed = False
+        for i in pending:
+            lease = leases_path.joinpath(i.name + '.lease')
+            result = results_path.joinpath(i.name + '.csv')
+            owner = claim(lease, lease_timeout)
+            if not owner:
+                continue
+            # the previous owner may have finished just before its lease was taken over
+            if result.exists():
+                release(lease, owner)
+                continue
+            claimed = True
+
+            # keep the lease alive while counting
+            stop = threading.Event()
+            beat = threading.Thread(target=heartbeat, args=(lease, owner, lease_timeout / 3, stop))
+            beat.start()
+            try:
+                try:
+                    row = count_file(i, **params)
+                except Exception as error:
+                    # a file the pipeline cannot handle (e.g. a truncated TIFF) gets an empty row and
+                    # an .error file, so other workers do not retry it and the merge can still finish
+                    print('Could not process ' + i.name + ': ' + str(error))
+                    results_path.joinpath(i.name + '.error').write_text(repr(error) + '\n')
+                    row = [split_ext(i.name)[0], method, '', '']
+                write_result(result, row)
+                processed += 1
+            finally:
+                stop.set()
+                beat.join()
+                release(lease, owner)
+
+        # everything left is leased by other workers: wait for them, or for their leases to go stale
+        if not claimed:
+            time.sleep(poll)
+
+    # every worker that sees all results merges them; the output is identical each time
+    merge_results(files, results_path, outCsv)
+    return processed
+
+
+def run_local(path, processes=4, **params):
+    """
+    Start several local worker processes on the same folder and wait for all of them,
+    e.g. to run the distributed mode on one machine. Keyword arguments are passed on to work().
+    """
+    workers = [Process(target=work, args=(path,), kwargs=params) for _ in range(processes)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+# get the path from command line and join the other workers
+if __name__ == "__main__":  # only executed if ran as script
+    path = argv[1]
+    work(path)